@@ -53,7 +53,10 @@ def run_cli_mode():
 
 def check_dependencies():
     """Check if all dependencies are installed"""
-    required = ['requests', 'telegram', 'fastapi', 'uvicorn', 'aiohttp', 'websockets']
+    required = ['requests', 'telegram', 'fastapi', 'uvicorn', 'aiohttp', 'websockets',
+                'orjson', 'msgspec', 'httptools']
+    if sys.platform != 'win32':
+        required.append('uvloop')  # no Windows build
     missing = []
     
     for module in required:
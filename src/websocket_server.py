@@ -5,23 +5,42 @@ Connects Telegram Bot with Browser Extension
 """
 
 import asyncio
-import json
+import sys
 import time
 import logging
-from typing import Dict, Set
-from datetime import datetime
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set
+
+import msgspec
+import orjson
+from websockets.exceptions import ConnectionClosed
 
 # FastAPI and WebSocket
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from fastapi.responses import Response
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="TempMail OTP Auto-Fill Server")
+# Limits on state kept for offline users
+MAX_USERS = 10_000
+PENDING_OTP_TTL = 600  # seconds
+REAPER_INTERVAL = 60  # seconds
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the pending OTP reaper for the lifetime of the app"""
+    reaper = asyncio.create_task(_reap_pending_otps())
+    yield
+    reaper.cancel()
+
+app = FastAPI(
+    title="TempMail OTP Auto-Fill Server",
+    lifespan=lifespan
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -32,86 +51,229 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Errors raised when writing to a socket the client already closed
+_SEND_ERRORS = (WebSocketDisconnect, ConnectionClosed, RuntimeError, OSError)
+
+# MessagePack codec for clients connecting with ?fmt=msgpack
+_msgpack_encoder = msgspec.msgpack.Encoder()
+_msgpack_decoder = msgspec.msgpack.Decoder()
+
+def _encode(data: dict, use_msgpack: bool = False):
+    """Encode as msgpack bytes, or as orjson text (clients use JSON.parse)"""
+    if use_msgpack:
+        return _msgpack_encoder.encode(data)
+    return orjson.dumps(data).decode()
+
+async def _send_encoded(websocket: WebSocket, payload):
+    """Send an already-encoded payload as a binary or text frame"""
+    if isinstance(payload, bytes):
+        await websocket.send_bytes(payload)
+    else:
+        await websocket.send_text(payload)
+
+async def _send(websocket: WebSocket, data: dict, use_msgpack: bool = False):
+    """Encode and send a single message"""
+    await _send_encoded(websocket, _encode(data, use_msgpack))
+
+def _json_response(data, status_code: int = 200) -> Response:
+    """JSON response encoded by orjson, skipping FastAPI's jsonable_encoder"""
+    return Response(orjson.dumps(data), status_code=status_code, media_type="application/json")
+
+class UserState(msgspec.Struct):
+    """Connection, current email and pending OTP for one user"""
+    ws: Optional[WebSocket] = None
+    email: Optional[str] = None
+    pending: Optional[dict] = None
+    msgpack: bool = False  # speaks msgpack instead of JSON
+
 # Store active connections and pending OTPs
 class ConnectionManager:
+    __slots__ = ("users", "connections", "offline", "pending_users")
+    
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.pending_otps: Dict[str, Dict] = {}
-        self.user_emails: Dict[str, str] = {}  # user_id -> current_email
+        self.users: Dict[str, UserState] = {}
+        # Indexes over users, kept in step so counts never scan every record
+        self.connections: Dict[str, UserState] = {}  # users with an open socket
+        self.offline: OrderedDict[str, None] = OrderedDict()  # eviction order, oldest first
+        self.pending_users: Set[str] = set()  # users holding an undelivered OTP
+    
+    @property
+    def connected_count(self) -> int:
+        return len(self.connections)
+    
+    @property
+    def pending_count(self) -> int:
+        return len(self.pending_users)
+    
+    def get_user(self, user_id: str) -> UserState:
+        """Get user state, creating it on first use"""
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = UserState()
+            self.offline[user_id] = None
+            self._evict_offline(keep=user_id)
+        elif user_id in self.offline:
+            self.offline.move_to_end(user_id)
+        return state
+    
+    def _evict_offline(self, keep: str):
+        """Drop least recently used offline users beyond MAX_USERS, sparing `keep`"""
+        while len(self.users) > MAX_USERS and self.offline:
+            user_id = next(iter(self.offline))
+            if user_id == keep:
+                # `keep` is newest, so it is only first when no one else is offline
+                break
+            del self.offline[user_id]
+            del self.users[user_id]
+            self.pending_users.discard(user_id)
+    
+    def set_pending(self, user_id: str, data: dict):
+        """Store an OTP until the user connects"""
+        self.get_user(user_id).pending = data
+        self.pending_users.add(user_id)
+    
+    def take_pending(self, state: UserState, user_id: str) -> Optional[dict]:
+        """Remove and return the user's pending OTP, if any"""
+        data, state.pending = state.pending, None
+        self.pending_users.discard(user_id)
+        return data
+    
+    def expire_pending(self):
+        """Drop pending OTPs older than PENDING_OTP_TTL"""
+        cutoff = time.time_ns() - PENDING_OTP_TTL * 1_000_000_000
+        for user_id in list(self.pending_users):
+            state = self.users[user_id]
+            if state.pending["timestamp"] < cutoff:
+                self.take_pending(state, user_id)
         
-    async def connect(self, websocket: WebSocket, user_id: str):
-        """Accept new WebSocket connection"""
+    async def connect(self, websocket: WebSocket, user_id: str) -> UserState:
+        """Accept new WebSocket connection and return the user's state"""
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info(f"✅ User {user_id} connected")
+        state = self.get_user(user_id)
+        state.ws = websocket
+        state.msgpack = websocket.query_params.get("fmt") == "msgpack"
+        self.connections[user_id] = state
+        self.offline.pop(user_id, None)
+        logger.info("✅ User %s connected", user_id)
         
         # Send any pending OTP
-        if user_id in self.pending_otps:
-            await self.send_otp(user_id, self.pending_otps.pop(user_id))
+        if state.pending is not None:
+            await self.send_otp(user_id, self.take_pending(state, user_id))
+        return state
     
     def disconnect(self, user_id: str):
         """Remove WebSocket connection"""
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"❌ User {user_id} disconnected")
+        state = self.connections.pop(user_id, None)
+        if state is not None:
+            state.ws = None
+            state.msgpack = False
+            self.offline[user_id] = None
+            logger.info("❌ User %s disconnected", user_id)
     
     async def send_otp(self, user_id: str, data: dict):
         """Send OTP to connected user"""
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
+        state = self.connections.get(user_id)
+        if state is not None:
             try:
-                await websocket.send_json(data)
-                logger.info(f"📤 OTP sent to {user_id}: {data.get('otp')}")
+                await _send(state.ws, data, state.msgpack)
+                logger.info("📤 OTP sent to %s: %s", user_id, data.get("otp"))
                 return True
-            except:
+            except _SEND_ERRORS:
                 self.disconnect(user_id)
                 return False
         return False
     
     async def broadcast_status(self):
         """Broadcast server status to all connections"""
+        connected = list(self.connections.items())
         status = {
             "type": "status",
-            "connected_users": len(self.active_connections),
-            "pending_otps": len(self.pending_otps),
-            "timestamp": datetime.now().isoformat()
+            "connected_users": len(connected),
+            "pending_otps": self.pending_count,
+            "timestamp": time.time_ns()
         }
         
-        for user_id, websocket in list(self.active_connections.items()):
-            try:
-                await websocket.send_json(status)
-            except:
-                self.disconnect(user_id)
+        # Encode once per wire format, not once per connection
+        payloads = {False: _encode(status)}
+        if any(state.msgpack for _, state in connected):
+            payloads[True] = _encode(status, True)
+        
+        # Send concurrently so one slow socket does not hold up the rest
+        await asyncio.gather(*(
+            self._safe_send(user_id, state.ws, payloads[state.msgpack])
+            for user_id, state in connected
+        ))
+    
+    async def _safe_send(self, user_id: str, websocket: WebSocket, payload):
+        """Send an encoded payload, dropping the connection on failure"""
+        try:
+            await _send_encoded(websocket, payload)
+        except _SEND_ERRORS:
+            self.disconnect(user_id)
 
 manager = ConnectionManager()
 
-# Data models
-class OTPData(BaseModel):
+async def _reap_pending_otps():
+    """Periodically expire OTPs that were never picked up"""
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        manager.expire_pending()
+
+# Data models (validated straight from the request body by msgspec)
+class OTPData(msgspec.Struct):
     user_id: str
     otp: str
     email: str
     sender: str = "Unknown"
     domain: str = ""
     
-class EmailData(BaseModel):
+class EmailData(msgspec.Struct):
     user_id: str
     email: str
 
+async def _decode_body(request: Request, type_):
+    """Parse and validate a JSON request body in a single msgspec pass"""
+    return msgspec.json.decode(await request.body(), type=type_)
+
+def _request_body(type_) -> dict:
+    """openapi_extra documenting a body read by _decode_body (refs inlined)"""
+    schema = msgspec.json.schema(type_)
+    defs = schema.pop("$defs", {})
+    
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(defs[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+    
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": resolve(schema)}}
+        }
+    }
+
+@app.exception_handler(msgspec.DecodeError)
+async def invalid_body_handler(request: Request, exc: msgspec.DecodeError):
+    """Report malformed or invalid request bodies as 422, like FastAPI does"""
+    return _json_response({"detail": str(exc)}, status_code=422)
+
 # API Endpoints
 @app.get("/")
 async def root():
     """Health check and status"""
-    return {
+    return _json_response({
         "status": "running",
         "service": "TempMail OTP Auto-Fill Server",
-        "connected_users": len(manager.active_connections),
-        "pending_otps": len(manager.pending_otps)
-    }
+        "connected_users": manager.connected_count,
+        "pending_otps": manager.pending_count
+    })
 
-@app.get("/dashboard")
-async def dashboard():
-    """Simple dashboard HTML"""
-    html = """
+# Dashboard page is static, so encode it once at import
+_DASHBOARD_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -186,89 +348,120 @@ async def dashboard():
     </body>
     </html>
     """
-    return HTMLResponse(content=html)
+_DASHBOARD_BYTES = _DASHBOARD_HTML.encode("utf-8")
+
+@app.get("/dashboard")
+async def dashboard():
+    """Simple dashboard HTML"""
+    return Response(content=_DASHBOARD_BYTES, media_type="text/html")
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     """WebSocket endpoint for browser extensions"""
-    await manager.connect(websocket, user_id)
+    state = await manager.connect(websocket, user_id)
+    use_msgpack = state.msgpack
     
     try:
+        # Keepalive is handled by uvicorn's protocol-level ping frames
         while True:
-            # Keep connection alive and handle messages
-            try:
-                data = await asyncio.wait_for(websocket.receive_text(), timeout=30)
-                message = json.loads(data)
-                
-                # Handle ping/pong
-                if message.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
-                
-                # Handle status request
-                elif message.get("type") == "status":
-                    status = {
-                        "type": "status",
-                        "connected": True,
-                        "email": manager.user_emails.get(user_id),
-                        "timestamp": time.time()
-                    }
-                    await websocket.send_json(status)
-                    
-            except asyncio.TimeoutError:
-                # Send ping to keep connection alive
-                await websocket.send_json({"type": "ping"})
+            if use_msgpack:
+                message = _msgpack_decoder.decode(await websocket.receive_bytes())
+            else:
+                message = orjson.loads(await websocket.receive_text())
+            
+            # Handle ping/pong
+            if message.get("type") == "ping":
+                await _send(websocket, {"type": "pong"}, use_msgpack)
+            
+            # Handle status request
+            elif message.get("type") == "status":
+                status = {
+                    "type": "status",
+                    "connected": True,
+                    "email": state.email,
+                    "timestamp": time.time_ns()
+                }
+                await _send(websocket, status, use_msgpack)
                 
     except WebSocketDisconnect:
         manager.disconnect(user_id)
     except Exception as e:
-        logger.error(f"WebSocket error for {user_id}: {e}")
+        logger.error("WebSocket error for %s: %s", user_id, e)
         manager.disconnect(user_id)
 
-@app.post("/api/otp")
-async def receive_otp(data: OTPData):
-    """Receive OTP from Telegram bot"""
-    otp_info = {
+# Hot endpoints return _json_response directly so FastAPI skips jsonable_encoder
+def _otp_message(data: OTPData) -> dict:
+    """Build the OTP message sent to the extension"""
+    return {
         "type": "otp",
         "otp": data.otp,
         "email": data.email,
         "sender": data.sender,
         "domain": data.domain,
-        "timestamp": time.time()
+        "timestamp": time.time_ns()
     }
+
+async def _deliver_otps(user_id: str, otps: List[dict]) -> str:
+    """Send OTPs in order, storing the newest one if the user is offline"""
+    for otp_info in otps:
+        if not await manager.send_otp(user_id, otp_info):
+            # Only the latest OTP is kept for later, same as /api/otp
+            manager.set_pending(user_id, otps[-1])
+            logger.info("📦 OTP stored for %s (offline)", user_id)
+            return "pending"
+    logger.info("✅ OTP delivered to %s", user_id)
+    return "delivered"
+
+@app.post("/api/otp", openapi_extra=_request_body(OTPData))
+async def receive_otp(request: Request):
+    """Receive OTP from Telegram bot"""
+    data = await _decode_body(request, OTPData)
+    status = await _deliver_otps(data.user_id, [_otp_message(data)])
+    return _json_response({"status": status, "user_id": data.user_id})
+
+@app.post("/api/otp/batch", openapi_extra=_request_body(List[OTPData]))
+async def receive_otp_batch(request: Request):
+    """Receive several OTPs from Telegram bot in one request"""
+    items = await _decode_body(request, List[OTPData])
+    by_user: Dict[str, List[dict]] = defaultdict(list)
+    for data in items:
+        by_user[data.user_id].append(_otp_message(data))
     
-    # Try to send immediately
-    if await manager.send_otp(data.user_id, otp_info):
-        logger.info(f"✅ OTP delivered to {data.user_id}")
-        return {"status": "delivered", "user_id": data.user_id}
-    else:
-        # Store for later
-        manager.pending_otps[data.user_id] = otp_info
-        logger.info(f"📦 OTP stored for {data.user_id} (offline)")
-        return {"status": "pending", "user_id": data.user_id}
+    statuses = await asyncio.gather(*(
+        _deliver_otps(user_id, otps) for user_id, otps in by_user.items()
+    ))
+    return _json_response({
+        "results": [
+            {"status": status, "user_id": user_id}
+            for user_id, status in zip(by_user, statuses)
+        ]
+    })
 
-@app.post("/api/email")
-async def register_email(data: EmailData):
+@app.post("/api/email", openapi_extra=_request_body(EmailData))
+async def register_email(request: Request):
     """Register new email for user"""
-    manager.user_emails[data.user_id] = data.email
+    data = await _decode_body(request, EmailData)
+    manager.get_user(data.user_id).email = data.email
     
     # Notify extension
     email_info = {
         "type": "new_email",
         "email": data.email,
-        "timestamp": time.time()
+        "timestamp": time.time_ns()
     }
     
     await manager.send_otp(data.user_id, email_info)
-    return {"status": "registered", "email": data.email}
+    return _json_response({"status": "registered", "email": data.email})
 
 @app.get("/api/status/{user_id}")
 async def user_status(user_id: str):
     """Get user connection status"""
-    return {
-        "connected": user_id in manager.active_connections,
-        "email": manager.user_emails.get(user_id),
-        "has_pending": user_id in manager.pending_otps
-    }
+    state = manager.users.get(user_id) or UserState()
+    return _json_response({
+        "connected": state.ws is not None,
+        "email": state.email,
+        "has_pending": state.pending is not None
+    })
 
 def main():
     """Run the server"""
@@ -282,7 +475,15 @@ def main():
         app, 
         host="0.0.0.0", 
         port=8000,
-        log_level="info"
+        log_level="info",
+        ws_ping_interval=20,
+        ws_ping_timeout=20,
+        # uvloop has no Windows build; fall back to the stdlib loop there
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        # C-accelerated protocol parsers instead of the h11/wsproto fallbacks
+        http="httptools",
+        ws="websockets",
+        lifespan="on"
     )
 
 if __name__ == "__main__":